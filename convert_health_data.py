@@ -2,13 +2,23 @@
 
 # Convert Apple Health export.xml and export_cda.xml files into a consolidated CSV file.
 
+import contextlib
 import csv
+import functools
+import heapq
+import itertools
+import mmap
 import os
-import glob
+import re
+import tempfile
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from operator import itemgetter
+from typing import Any, BinaryIO, Callable, Iterable, Iterator, Optional, Sequence
+from xml.parsers import expat
 
-TARGET_TYPES = {
+TARGET_TYPES = frozenset({
     # Activity
     'HKQuantityTypeIdentifierStepCount',
     'HKQuantityTypeIdentifierActiveEnergyBurned',
@@ -26,113 +36,155 @@ TARGET_TYPES = {
     'HKQuantityTypeIdentifierRespiratoryRate',
     # Sedentary Monitor
     'HKCategoryTypeIdentifierAppleStandHour',
+})
+
+# Rows held in memory at once while sorting the spooled records.
+CHUNK_SIZE = 500_000
+
+# Rows encoded and handed to the file in a single write() call.
+WRITE_BATCH_ROWS = 4096
+
+# HL7 CDA tags in Clark notation. Plain tags let find() scan the children in
+# C instead of resolving a 'cda:' prefix through ElementPath on every call.
+CDA_NS = '{urn:hl7-org:v3}'
+CDA_ENTRY = f'{CDA_NS}entry'
+CDA_OBSERVATION = f'{CDA_NS}observation'
+CDA_TEXT = f'{CDA_NS}text'
+CDA_TYPE = f'{CDA_NS}type'
+CDA_VALUE = f'{CDA_NS}value'
+CDA_EFFECTIVE_TIME = f'{CDA_NS}effectiveTime'
+CDA_LOW = f'{CDA_NS}low'
+CDA_HIGH = f'{CDA_NS}high'
+
+# CDA timestamps look like YYYYMMDDHHMMSS followed by an optional UTC offset.
+CDA_DATE_RE = re.compile(r'([0-9]{4})([0-9]{2})([0-9]{2})([0-9]{2})([0-9]{2})([0-9]{2})(.*)', re.DOTALL)
+
+# Bytes read from the start of each ECG CSV; enough to cover its metadata.
+ECG_HEADER_BYTES = 2048
+
+# The per-record functions are annotated so the module can be compiled with
+# mypyc as-is (see README); plain CPython ignores the annotations.
+WriteRow = Callable[[tuple[str, ...]], Any]
+
+def handle_record(
+    attrs: dict[str, str],
+    writerow: WriteRow,
+    target_types: frozenset[str] = TARGET_TYPES,
+) -> bool:
+    """Write a Record if it is a target type; return True if it was written."""
+    # Record types are not interned: the lookup in sys.intern costs more per
+    # record than the string compare it would save on a set hit.
+    record_type = attrs.get('type')
+    if record_type not in target_types:
+        return False
+    
+    writerow((
+        attrs.get('creationDate', ''),
+        attrs.get('startDate', ''),
+        attrs.get('endDate', ''),
+        record_type,
+        attrs.get('value', ''),
+    ))
+    return True
+
+def handle_workout(attrs: dict[str, str], writerow: WriteRow) -> bool:
+    """Write a Workout with its duration and energy summary; return True."""
+    workout_type = attrs.get('workoutActivityType', '')
+    creation_date = attrs.get('creationDate', '')
+    start_date = attrs.get('startDate', '')
+    end_date = attrs.get('endDate', '')
+    duration = attrs.get('duration', '')
+    duration_unit = attrs.get('durationUnit', 'min')
+    total_energy = attrs.get('totalEnergyBurned', '')
+    energy_unit = attrs.get('totalEnergyBurnedUnit', 'Cal')
+    
+    value_parts = []
+    if duration:
+        value_parts.append(f"duration:{duration} {duration_unit}")
+    if total_energy:
+        value_parts.append(f"calories:{total_energy} {energy_unit}")
+    value = '; '.join(value_parts) if value_parts else ''
+    
+    writerow((creation_date, start_date, end_date, workout_type, value))
+    return True
+
+# export.xml element tag -> handler called with the element's attributes.
+ELEMENT_HANDLERS: dict[str, Callable[[dict[str, str], WriteRow], bool]] = {
+    'Record': handle_record,
+    'Workout': handle_workout,
 }
 
-def parse_export_xml(filepath, records, seen_keys):
-    """Parse export.xml using iterparse for memory efficiency."""
+def parse_export_xml(filepath: str, writer: Any) -> int:
+    """Parse export.xml with expat callbacks, without building any elements.
+    
+    Records and workouts carry everything we need in their attributes, so
+    only start tags are handled and child elements are never looked at.
+    """
     print(f"Processing: {filepath}")
     count = 0
-    local_count = 0
-    workout_count = 0
+    tag_counts: Counter[str] = Counter()
     
-    context = ET.iterparse(filepath, events=('end',))
+    # Bound locally to keep global and attribute lookups out of the callback.
+    handlers_get = ELEMENT_HANDLERS.get
+    writerow = writer.writerow
     
-    for event, elem in context:
-        if elem.tag == 'Record':
-            record_type = elem.get('type')
-            if record_type in TARGET_TYPES:
-                creation_date = elem.get('creationDate', '')
-                start_date = elem.get('startDate', '')
-                end_date = elem.get('endDate', '')
-                value = elem.get('value', '')
-                
-                key = (creation_date, start_date, end_date, record_type, value)
-                if key not in seen_keys:
-                    seen_keys.add(key)
-                    records.append({
-                        'creationDate': creation_date,
-                        'startDate': start_date,
-                        'endDate': end_date,
-                        'type': record_type,
-                        'value': value
-                    })
-                    local_count += 1
-                    count += 1
-                    
-                    if count % 50000 == 0:
-                        print(f"  Progress: {count:,} records extracted...")
+    def start_element(name: str, attrs: dict[str, str]) -> None:
+        nonlocal count
+        handler = handlers_get(name)
+        if handler is not None and handler(attrs, writerow):
+            tag_counts[name] += 1
+            count += 1
             
-            elem.clear()
-        
-        elif elem.tag == 'Workout':
-            workout_type = elem.get('workoutActivityType', '')
-            creation_date = elem.get('creationDate', '')
-            start_date = elem.get('startDate', '')
-            end_date = elem.get('endDate', '')
-            duration = elem.get('duration', '')
-            duration_unit = elem.get('durationUnit', 'min')
-            total_energy = elem.get('totalEnergyBurned', '')
-            energy_unit = elem.get('totalEnergyBurnedUnit', 'Cal')
-            
-            value_parts = []
-            if duration:
-                value_parts.append(f"duration:{duration} {duration_unit}")
-            if total_energy:
-                value_parts.append(f"calories:{total_energy} {energy_unit}")
-            value = '; '.join(value_parts) if value_parts else ''
-            
-            key = (creation_date, start_date, end_date, workout_type, value)
-            if key not in seen_keys:
-                seen_keys.add(key)
-                records.append({
-                    'creationDate': creation_date,
-                    'startDate': start_date,
-                    'endDate': end_date,
-                    'type': workout_type,
-                    'value': value
-                })
-                workout_count += 1
-                count += 1
-                
-                if count % 50000 == 0:
-                    print(f"  Progress: {count:,} records extracted...")
-            
-            elem.clear()
+            if count % 50000 == 0:
+                print(f"  Progress: {count:,} records extracted...")
+    
+    parser = expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    # Hand expat the mapped file directly; pages are read in on demand instead
+    # of being copied through Python's buffered reader.
+    with open(filepath, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        parser.Parse(mm, True)
     
-    print(f"  Extracted {local_count:,} records + {workout_count:,} workouts from {os.path.basename(filepath)}")
+    print(f"  Extracted {tag_counts['Record']:,} records + {tag_counts['Workout']:,} workouts from {os.path.basename(filepath)}")
     return count
 
-def parse_export_cda_xml(filepath, records, seen_keys):
+def parse_export_cda_xml(filepath: str, writer: Any) -> int:
     """Parse export_cda.xml (HL7 CDA format) using iterparse."""
     print(f"Processing: {filepath}")
     count = 0
-    local_count = 0
-    total_count = len(records)
-    
-    ns = {'cda': 'urn:hl7-org:v3'}
     
     try:
-        context = ET.iterparse(filepath, events=('end',))
+        # Observations are nested several levels below a section that stays
+        # open for the whole file, so clearing them alone leaves every finished
+        # entry wrapper attached. Track the open elements and detach each entry
+        # from its parent once it ends.
+        context = ET.iterparse(filepath, events=('start', 'end'))
+        stack = []
         
         for event, elem in context:
-            if elem.tag == '{urn:hl7-org:v3}observation':
-                text_elem = elem.find('cda:text', ns)
+            if event == 'start':
+                stack.append(elem)
+                continue
+            stack.pop()
+            
+            if elem.tag == CDA_ENTRY:
+                if stack:
+                    stack[-1].remove(elem)
+            elif elem.tag == CDA_OBSERVATION:
+                text_elem = elem.find(CDA_TEXT)
                 if text_elem is not None:
-                    type_elem = text_elem.find('cda:type', ns)
-                    if type_elem is not None and type_elem.text in TARGET_TYPES:
-                        record_type = type_elem.text
+                    record_type = text_elem.findtext(CDA_TYPE) or ''
+                    if record_type in TARGET_TYPES:
+                        value = text_elem.findtext(CDA_VALUE, '')
                         
-                        value_elem = text_elem.find('cda:value', ns)
-                        value = value_elem.text if value_elem is not None else ''
-                        
-                        effective_time = elem.find('cda:effectiveTime', ns)
+                        effective_time = elem.find(CDA_EFFECTIVE_TIME)
                         start_date = ''
                         end_date = ''
                         creation_date = ''
                         
                         if effective_time is not None:
-                            low = effective_time.find('cda:low', ns)
-                            high = effective_time.find('cda:high', ns)
+                            low = effective_time.find(CDA_LOW)
+                            high = effective_time.find(CDA_HIGH)
                             if low is not None:
                                 start_date = format_cda_date(low.get('value', ''))
                             if high is not None:
@@ -140,96 +192,186 @@ def parse_export_cda_xml(filepath, records, seen_keys):
                         
                         creation_date = start_date
                         
-                        key = (creation_date, start_date, end_date, record_type, value)
-                        if key not in seen_keys:
-                            seen_keys.add(key)
-                            records.append({
-                                'creationDate': creation_date,
-                                'startDate': start_date,
-                                'endDate': end_date,
-                                'type': record_type,
-                                'value': value
-                            })
-                            local_count += 1
-                            count += 1
-                            
-                            if (total_count + count) % 50000 == 0:
-                                print(f"  Progress: {total_count + count:,} records extracted...")
+                        writer.writerow((creation_date, start_date, end_date, record_type, value))
+                        count += 1
+                        
+                        if count % 50000 == 0:
+                            print(f"  Progress: {count:,} records extracted...")
                 
                 elem.clear()
     except ET.ParseError as e:
         print(f"  Warning: CDA file has malformed XML, skipping. Error: {e}")
         print(f"  (export.xml likely contains the same data)")
     
-    print(f"  Extracted {local_count:,} new records from {os.path.basename(filepath)}")
+    print(f"  Extracted {count:,} records from {os.path.basename(filepath)}")
     return count
 
-def format_cda_date(date_str):
-    """Convert CDA date format (YYYYMMDDHHMMSS+ZZZZ) to readable format."""
-    if not date_str:
-        return ''
+@functools.lru_cache(maxsize=65536)
+def format_cda_date(date_str: str) -> str:
+    """Convert CDA date format (YYYYMMDDHHMMSS+ZZZZ) to readable format.
+    
+    Plain string slicing; samples taken close together share timestamps,
+    so results are cached.
+    """
+    m = CDA_DATE_RE.fullmatch(date_str)
+    if m is None:
+        return date_str
+    tz = f' {m[7]}' if m[7] else ''
+    return f"{m[1]}-{m[2]}-{m[3]} {m[4]}:{m[5]}:{m[6]}{tz}"
+
+def parse_ecg_file(filepath: str) -> Optional[tuple[str, str, str, str, str]]:
+    """Read the metadata header of one ECG CSV; return its record or None."""
     try:
-        if len(date_str) >= 14:
-            base = date_str[:14]
-            tz = date_str[14:] if len(date_str) > 14 else ''
-            dt = datetime.strptime(base, '%Y%m%d%H%M%S')
-            formatted = dt.strftime('%Y-%m-%d %H:%M:%S')
-            if tz:
-                formatted += f' {tz}'
-            return formatted
-    except ValueError:
-        pass
-    return date_str
+        # The metadata sits in the first few hundred bytes, so a single read
+        # covers it without iterating over the voltage samples line by line.
+        with open(filepath, 'rb') as f:
+            head = f.read(ECG_HEADER_BYTES).decode('utf-8', 'replace')
+        
+        metadata: dict[str, str] = {}
+        for line in head.splitlines()[:11]:
+            if ',' in line:
+                key, value = line.split(',', 1)
+                metadata[key.strip()] = value.strip().strip('"')
+        
+        recorded_date = metadata.get('Recorded Date', '')
+        classification = metadata.get('Classification', '')
+    except Exception as e:
+        print(f"  Warning: Could not parse {filepath}: {e}")
+        return None
+    
+    if not recorded_date:
+        return None
+    return (recorded_date, recorded_date, recorded_date, 'ECG', classification)
 
-def parse_ecg_files(ecg_dir, records, seen_keys):
+def parse_ecg_files(ecg_dir, writer):
     """Parse ECG CSV files and extract metadata."""
     print(f"Processing ECG files from: {ecg_dir}")
     count = 0
-    total_count = len(records)
-    
-    ecg_files = glob.glob(os.path.join(ecg_dir, 'ecg_*.csv'))
     
-    for filepath in ecg_files:
-        try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                lines = []
-                for i, line in enumerate(f):
-                    lines.append(line.strip())
-                    if i >= 10:
-                        break
-                
-                metadata = {}
-                for line in lines:
-                    if ',' in line:
-                        parts = line.split(',', 1)
-                        if len(parts) == 2:
-                            key, value = parts[0].strip(), parts[1].strip().strip('"')
-                            metadata[key] = value
-                
-                recorded_date = metadata.get('Recorded Date', '')
-                classification = metadata.get('Classification', '')
-                
-                if recorded_date:
-                    record_key = (recorded_date, recorded_date, recorded_date, 'ECG', classification)
-                    if record_key not in seen_keys:
-                        seen_keys.add(record_key)
-                        records.append({
-                            'creationDate': recorded_date,
-                            'startDate': recorded_date,
-                            'endDate': recorded_date,
-                            'type': 'ECG',
-                            'value': classification
-                        })
-                        count += 1
-                        
-                        if (total_count + count) % 50000 == 0:
-                            print(f"  Progress: {total_count + count:,} records extracted...")
-        except Exception as e:
-            print(f"  Warning: Could not parse {filepath}: {e}")
+    # Reading the headers is dominated by file opens, so threads overlap them.
+    with os.scandir(ecg_dir) as entries, ThreadPoolExecutor() as executor:
+        ecg_files = (
+            entry.path for entry in entries
+            if entry.name.startswith('ecg_') and entry.name.endswith('.csv')
+        )
+        for row in executor.map(parse_ecg_file, ecg_files):
+            if row is None:
+                continue
+            writer.writerow(row)
+            count += 1
+            
+            if count % 50000 == 0:
+                print(f"  Progress: {count:,} records extracted...")
     
     print(f"  Extracted {count} ECG records")
     return count
 
+def spool_source(parse_func, source, spool_path):
+    """Run one parser in a worker process, writing its records to spool_path."""
+    with open(spool_path, 'w', newline='', encoding='utf-8') as spool:
+        return parse_func(source, csv.writer(spool))
+
+def read_unique_rows(spool_paths: list[str], interned: dict[str, str]) -> Iterator[list[str]]:
+    """Yield spooled records in source order, skipping exact duplicates.
+    
+    Types and values are looked up in `interned`, which the caller clears
+    between chunks.
+    """
+    # Dedup keys are 64-bit hashes of the five fields rather than the fields
+    # themselves, which keeps the set about a third of the size. All rows are
+    # hashed in this process, so per-process hash randomization does not
+    # matter, and a false match is unlikely at tens of millions of rows.
+    # The set is not pre-sized: CPython frees the table on clear(), and
+    # pre-growing it with throwaway entries costs more than the resizes it
+    # avoids.
+    seen_keys = set()
+    # Types and values repeat across many records, so rows in a chunk share
+    # one string per distinct type and value instead of each holding its own
+    # copy. Interning as rows are read keeps the duplicates from ever piling
+    # up in the chunk.
+    intern = interned.setdefault
+    for spool_path in spool_paths:
+        with open(spool_path, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                key = hash(tuple(row))
+                if key not in seen_keys:
+                    seen_keys.add(key)
+                    row[3] = intern(row[3], row[3])
+                    row[4] = intern(row[4], row[4])
+                    yield row
+
+def quote_csv_field(field: str) -> str:
+    """Quote a CSV field the way csv.writer does, only when it needs it."""
+    if ',' in field or '"' in field or '\n' in field or '\r' in field:
+        return '"' + field.replace('"', '""') + '"'
+    return field
+
+def write_rows(f: BinaryIO, rows: Iterable[Sequence[str]]) -> None:
+    """Write records as CSV lines to a binary file, encoding them in batches.
+    
+    Every field is quoted the way csv.writer would, and lines end in \r\n
+    to match its default, so csv.reader reads the files back unchanged. The
+    date and type columns are usually fixed-format, so they are checked
+    together as one string and only quoted field by field when that check
+    finds an extra comma, a quote or a line break (e.g. a free-form ECG
+    "Recorded Date" or a CDA timestamp that could not be reformatted).
+    """
+    batch: list[str] = []
+    append = batch.append
+    for creation_date, start_date, end_date, record_type, value in rows:
+        head = f"{creation_date},{start_date},{end_date},{record_type}"
+        if head.count(',') != 3 or '"' in head or '\n' in head or '\r' in head:
+            head = ','.join(map(quote_csv_field, (creation_date, start_date, end_date, record_type)))
+        append(f"{head},{quote_csv_field(value)}\r\n")
+        if len(batch) >= WRITE_BATCH_ROWS:
+            f.write(''.join(batch).encode())
+            batch.clear()
+    f.write(''.join(batch).encode())
+
+def sort_chunks(spool_paths, tmp_dir):
+    """Deduplicate the spooled records into chunks sorted by startDate.
+    
+    Full chunks are written to files. The last, partial chunk is returned in
+    memory since it is merged straight away; for most exports it is the only
+    one, and the output is written without a round trip through disk.
+    Returns the chunk paths, the last chunk and the number of records per type.
+    """
+    chunk_paths = []
+    type_counts = Counter()
+    # String table shared by the rows of one chunk; cleared once the chunk is
+    # read so it never holds more than a chunk's distinct types and values.
+    interned: dict[str, str] = {}
+    rows = read_unique_rows(spool_paths, interned)
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        interned.clear()
+        chunk.sort(key=itemgetter(1))
+        # Counted while the chunk is in memory anyway; Counter.update over a
+        # map runs its loop in C, well ahead of a per-row `+= 1` in Python.
+        type_counts.update(map(itemgetter(3), chunk))
+        if len(chunk) < CHUNK_SIZE:
+            return chunk_paths, chunk, type_counts
+        
+        # merge_chunks reads these back with csv.reader and unpacks exactly five
+        # fields, which relies on write_rows quoting any field that needs it.
+        chunk_path = os.path.join(tmp_dir, f'chunk_{len(chunk_paths)}.csv')
+        with open(chunk_path, 'wb', buffering=1 << 20) as out:
+            write_rows(out, chunk)
+        chunk_paths.append(chunk_path)
+
+def merge_chunks(chunk_paths, last_chunk, output_csv):
+    """Merge the sorted chunk files and the in-memory last chunk into the output CSV."""
+    with contextlib.ExitStack() as stack:
+        readers = [
+            csv.reader(stack.enter_context(open(path, 'r', newline='', encoding='utf-8')))
+            for path in chunk_paths
+        ]
+        f = stack.enter_context(open(output_csv, 'wb', buffering=1 << 20))
+        f.write(b'creationDate,startDate,endDate,type,value\r\n')
+        
+        # heapq.merge breaks ties by chunk order, so this matches a stable sort.
+        write_rows(f, heapq.merge(*readers, last_chunk, key=itemgetter(1)))
+
 def main():
     base_dir = os.path.dirname(os.path.abspath(__file__))
     
@@ -238,9 +380,11 @@ def main():
     ecg_dir = os.path.join(base_dir, 'electrocardiograms')
     output_csv = os.path.join(base_dir, 'full_health_data.csv')
     
-    records = []
-    seen_keys = set()
-    total_count = 0
+    sources = [
+        (parse_export_xml, export_xml),
+        (parse_export_cda_xml, export_cda_xml),
+        (parse_ecg_files, ecg_dir),
+    ]
     
     print("=" * 60)
     print("Apple Health Data Converter")
@@ -248,44 +392,40 @@ def main():
     print(f"Target types: {', '.join(sorted(TARGET_TYPES))}")
     print()
     
-    if os.path.exists(export_xml):
-        total_count += parse_export_xml(export_xml, records, seen_keys)
-    else:
-        print(f"Warning: {export_xml} not found")
-    
-    if os.path.exists(export_cda_xml):
-        total_count += parse_export_cda_xml(export_cda_xml, records, seen_keys)
-    else:
-        print(f"Warning: {export_cda_xml} not found")
-    
-    if os.path.exists(ecg_dir):
-        total_count += parse_ecg_files(ecg_dir, records, seen_keys)
-    else:
-        print(f"Warning: {ecg_dir} not found")
-    
-    print()
-    print(f"Sorting {len(records):,} records by startDate...")
-    records.sort(key=lambda x: x['startDate'])
+    # Each source is parsed in its own process and streamed to a spool file.
+    # The spools are deduplicated and sorted externally afterwards, so at most
+    # CHUNK_SIZE record rows are held in memory; the dedup set still grows with
+    # every unique record.
+    with tempfile.TemporaryDirectory(dir=base_dir) as tmp_dir:
+        spool_paths = []
+        futures = []
+        with ProcessPoolExecutor(max_workers=len(sources)) as executor:
+            for parse_func, source in sources:
+                if not os.path.exists(source):
+                    print(f"Warning: {source} not found")
+                    continue
+                spool_path = os.path.join(tmp_dir, f'spool_{len(spool_paths)}.csv')
+                futures.append(executor.submit(spool_source, parse_func, source, spool_path))
+                spool_paths.append(spool_path)
+            
+            parsed_count = sum(future.result() for future in futures)
+        
+        print()
+        print(f"Sorting records from {parsed_count:,} parsed rows by startDate...")
+        chunk_paths, last_chunk, type_counts = sort_chunks(spool_paths, tmp_dir)
+        
+        print(f"Writing to {output_csv}...")
+        merge_chunks(chunk_paths, last_chunk, output_csv)
     
-    print(f"Writing to {output_csv}...")
-    with open(output_csv, 'w', newline='', encoding='utf-8') as f:
-        fieldnames = ['creationDate', 'startDate', 'endDate', 'type', 'value']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(records)
+    total_count = sum(type_counts.values())
     
     print()
     print("=" * 60)
     print("COMPLETE")
     print("=" * 60)
-    print(f"Total records written: {len(records):,}")
+    print(f"Total records written: {total_count:,}")
     print(f"Output file: {output_csv}")
     
-    type_counts = {}
-    for r in records:
-        t = r['type']
-        type_counts[t] = type_counts.get(t, 0) + 1
-    
     print("\nRecords by type:")
     for t in sorted(type_counts.keys()):
         print(f"  {t}: {type_counts[t]:,}")